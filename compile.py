@@ -10,15 +10,16 @@ https://opensource.org/licenses/MIT
 
 
 import argparse
+import collections
+import concurrent.futures
+import functools
+import itertools
 import os
 import pathlib
-import string
+import re
 import warnings
 
 
-CHAPTER = "\\chapter{{{}}}{{{}}}\n"
-SUBCHAPTER = "\t\\subchapter{{{}}}{{{}}}\n"
-SUBFILE = "\t\t\\subfile{{problems/{}.{}.{}{}.tex}}\n"
 BEGIN_DOC = "\\begin{document}\n"
 END_DOC = "\\end{document}"
 PROBLEM_PREAMBLE = """\\documentclass[../main.tex]{subfiles}\n"""
@@ -94,6 +95,73 @@ MAIN_PREAMBLE = r"""\documentclass[11pt,a4paper]{article}
 \DeclareMathOperator{\SetOfComplexNumbers}{\CC}
 """
 
+# A single non-blank line of the specification, after the title
+SPEC_LINE = re.compile(
+    r"""
+    ^[^\S\n]*
+    (?:
+        # # chapter_number chapter_name
+        # ## subchapter_number subchapter_name
+        (?P<level>\#{1,2}) [^\S\n]+
+        (?P<number>\S+) [^\S\n]+ (?P<name>\S[^\n]*?)
+    |
+        # [###] problem_number subproblems
+        (?: \#{3} [^\S\n]+ | (?! \#{1,3} (?:[^\S\n]|$) ) )
+        (?P<problem>\S+) (?: [^\S\n]+ (?P<subproblems>[a-z]+) )?
+    |
+        # Anything else is malformed
+        (?P<invalid>\S[^\n]*?)
+    )
+    [^\S\n]*$
+    """,
+    re.MULTILINE | re.VERBOSE,
+)
+
+
+# A problem file waiting to be written, with the spec lines that reference it
+# and the indices of their subfile lines in main_parts
+_PendingWrite = collections.namedtuple("_PendingWrite", ["content", "lines", "main_indices"])
+
+
+@functools.lru_cache(maxsize=None)
+def _subproblem_block(subproblems):
+    """Return the enumerate environment for the given subproblem letters."""
+    if not subproblems:
+        return "\n"
+    block = ["\\begin{enumerate}[a)]\n"]
+    subproblem_number = 0
+    # Consecutive letters share the same offset from their index
+    runs = itertools.groupby(
+        enumerate(subproblems),
+        key=lambda item: ord(item[1]) - item[0],
+    )
+    for _, run in runs:
+        run = list(run)
+        next_number = ord(run[0][1]) - ord("a")
+        if next_number != subproblem_number:
+            block.append(f"\t\\setcounter{{enumi}}{{{next_number}}}\n")
+        block.append("\t\\item \n" * len(run))
+        subproblem_number = next_number + len(run)
+    block.append("\\end{enumerate}\n")
+    return "".join(block)
+
+
+def _write_file(path, content):
+    """Write the bytes content to the file at path."""
+    with open(path, "wb") as file:
+        file.write(content)
+
+
+def _report_failure(line, panic_mode):
+    """Warn that a specification line could not be processed.
+
+    Returns the new panic mode, which is entered on the first failure.
+    """
+    if not panic_mode:
+        warnings.warn("Entering panic mode, output may be faulty")
+    warnings.warn("Failure processing specification line: " + repr(line))
+    return True
+
 
 def main(
         spec,
@@ -113,27 +181,38 @@ def main(
     dest.mkdir(exist_ok=True)
     (dest/"problems").mkdir(exist_ok=True)
 
-    # Read all the lines of the specification file
-    lines = iter(open(spec, "r").read().splitlines())
+    # Prefix for the problem file paths, so no Path objects are built per problem
+    problems_dir = os.fspath(dest/"problems") + os.sep
 
-    # The title of the latex document
-    title = next(lines)
+    # Names of the problem files already present, listed once up front
+    if overwrite:
+        existing_problem_files = set()
+    else:
+        with os.scandir(problems_dir) as entries:
+            existing_problem_files = {entry.name for entry in entries}
+
+    # Read the specification file, the first line of which is the title of the latex document
+    with open(spec, "r") as spec_file:
+        title, _, body = spec_file.read().partition("\n")
 
     # Create the main document
     main_file_path = dest/"main.tex"
-    if main_file_path.exists() and not overwrite:
+    write_main = overwrite or not main_file_path.exists()
+
+    # The contents of the main file, written out in one go at the end
+    main_parts = []
+    main_parts_append = main_parts.append
+    if write_main:
+        print("Writing main.tex")
+        main_parts_append(MAIN_PREAMBLE)
+        main_parts_append("\n")
+        main_parts_append(BEGIN_DOC)
+        main_parts_append("\n")
+        main_parts_append(MAIN_CONTENT.format(title))
+        main_parts_append("\n")
+    else:
         # The file exists and we don't want to overwrite it
         print("Not overwriting main.tex")
-        main_file = open(os.devnull, "w")
-    else:
-        print("Writing main.tex")
-        main_file = open(main_file_path, "w")
-        main_file.write(MAIN_PREAMBLE)
-        main_file.write("\n")
-        main_file.write(BEGIN_DOC)
-        main_file.write("\n")
-        main_file.write(MAIN_CONTENT.format(title))
-        main_file.write("\n")
 
     # Whether a processing error has occurred
     panic_mode = False
@@ -141,107 +220,90 @@ def main(
     # The numbers of the things (in string form)
     chapter = None
     subchapter = None
-    problem = None
-    subproblems = None  # This will just be a string; e.g., "abcf"
-
-    for line in lines:  # pylint: disable=too-many-nested-blocks
-        original_line = line
-        line = line.split(maxsplit=2)
-        if line:
-            try:
-                if line[0] == "#":
-                    # # chapter_number chapter_name
-                    assert len(line) == 3
-                    chapter = line[1]
-                    main_file.write(CHAPTER.format(chapter, line[2]))
-                elif line[0] == "##":
-                    # ## subchapter_number subchapter_name
-                    assert len(line) == 3
-                    subchapter = line[1]
-                    main_file.write(SUBCHAPTER.format(subchapter, line[2]))
-                else:
-                    if line[0] == "###":
-                        # ### problem_number subproblems
-                        assert len(line) < 4
-                        problem = line[1]
-                        subproblems = line[2] if len(line) == 3 else ""
-                    else:
-                        # problem_number subproblems
-                        assert len(line) < 3
-                        problem = line[0]
-                        subproblems = line[1] if len(line) == 2 else ""
-                    assert set(subproblems).issubset(string.ascii_lowercase)
-                    problem_file_name = "{}.{}.{}{}.tex".format(
-                        chapter,
-                        subchapter,
-                        problem,
-                        subproblems,
-                    )
-                    problem_file_path = dest/"problems"/problem_file_name
-                    if problem_file_path.exists() and not overwrite:
-                        # It already exists and we are not to overwrite it
-                        print("Not overwriting", problem_file_name)
-                    else:
-                        print("Writing", problem_file_name)
-                        content = []
-                        content.append(PROBLEM_PREAMBLE)
-                        content.append("\n")
-                        content.append(BEGIN_DOC)
-                        content.append("\n")
-
-                        problem_structure = []
-                        if subproblems:
-                            problem_structure.append("\\begin{enumerate}[a)]\n")
-                            subproblem_number = 0
-                            for character in subproblems:
-                                next_number = ord(character) - ord("a")
-                                if next_number != subproblem_number:
-                                    problem_number = next_number
-                                    problem_structure.append(
-                                        "\t\\setcounter{{enumi}}{{{}}}\n".format(problem_number),
-                                    )
-                                problem_structure.append("\t\\item \n")
-                                subproblem_number += 1
-                            problem_structure.append("\\end{enumerate}\n")
-                        else:
-                            problem_structure.append("\n")
-
-
-
-                        content.append("\\problem{" + problem + "}\n")
-                        content.extend(problem_structure)
-                        content.append("\n")
-                        content.append("\\solution\n")
-                        content.extend(problem_structure)
-                        content.append("\n")
-
-                        content.append(END_DOC)
-
-                        problem_file = open(problem_file_path, "w")
-                        for content_line in content:
-                            problem_file.write(content_line)
-
-                    # Lastly, write to the main file
-                    # If this or a previous step fails, the main file can still be compiled
-
-                    main_file.write(
-                        SUBFILE.format(
-                            chapter,
-                            subchapter,
-                            problem,
-                            subproblems,
-                        ),
-                    )
-                    main_file.write("\t\t\\pagebreak\n")
-
-            except Exception:  # pylint: disable=broad-except
-                if panic_mode:
-                    warnings.warn("Entering panic mode, output may be faulty")
-                    panic_mode = True
-                warnings.warn("Failure processing specification line: " + repr(original_line))
-
-    main_file.write("\n")
-    main_file.write(END_DOC)
+
+    # The problem files to write, by name
+    pending_writes = {}
+
+    for match in SPEC_LINE.finditer(body):
+        line = match[0]
+        level = match["level"]
+        if match["invalid"] is not None:
+            panic_mode = _report_failure(line, panic_mode)
+        elif level == "#":
+            chapter = match["number"]
+            if write_main:
+                main_parts_append(f"\\chapter{{{chapter}}}{{{match['name']}}}\n")
+        elif level == "##":
+            subchapter = match["number"]
+            if write_main:
+                main_parts_append(f"\t\\subchapter{{{subchapter}}}{{{match['name']}}}\n")
+        else:
+            problem = match["problem"]
+            subproblems = match["subproblems"] or ""  # This will just be a string; e.g., "abcf"
+            problem_file_name = f"{chapter}.{subchapter}.{problem}{subproblems}.tex"
+            pending = None
+            if problem_file_name in existing_problem_files:
+                # It already exists and we are not to overwrite it
+                print("Not overwriting", problem_file_name)
+            elif problem_file_name in pending_writes:
+                # A repeated line shares the outcome of the first write of the file
+                if overwrite:
+                    print("Writing", problem_file_name)
+                pending = pending_writes[problem_file_name]
+            else:
+                print("Writing", problem_file_name)
+                block = _subproblem_block(subproblems)
+                content = (
+                    f"{PROBLEM_PREAMBLE}\n"
+                    f"{BEGIN_DOC}\n"
+                    f"\\problem{{{problem}}}\n"
+                    f"{block}\n"
+                    "\\solution\n"
+                    f"{block}\n"
+                    f"{END_DOC}"
+                )
+                pending = pending_writes[problem_file_name] = _PendingWrite(
+                    content.encode("utf-8"), [], [],
+                )
+            if pending is not None:
+                pending.lines.append(line)
+                pending.main_indices.append(len(main_parts))
+
+            # Lastly, write to the main file
+            # If writing the problem file fails, this is undone so the main file can still be compiled
+
+            if write_main:
+                main_parts_append(f"\t\t\\subfile{{problems/{problem_file_name}}}\n")
+                main_parts_append("\t\t\\pagebreak\n")
+
+    # The problem files are independent of each other, so write them concurrently
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        futures = {
+            problem_file_name: executor.submit(
+                _write_file, problems_dir + problem_file_name, pending.content,
+            )
+            for problem_file_name, pending in pending_writes.items()
+        }
+    for problem_file_name, pending in pending_writes.items():
+        try:
+            futures[problem_file_name].result()
+        except (OSError, ValueError):
+            # ValueError is raised for paths such as those with null bytes
+            for line in pending.lines:
+                panic_mode = _report_failure(line, panic_mode)
+            if write_main:
+                for main_index in pending.main_indices:
+                    main_parts[main_index:main_index + 2] = "", ""
+            continue
+        # Repeated lines only learn that the file exists once it has been written
+        if not overwrite:
+            for _ in pending.lines[1:]:
+                print("Not overwriting", problem_file_name)
+
+    if write_main:
+        main_parts_append("\n")
+        main_parts_append(END_DOC)
+        _write_file(main_file_path, "".join(main_parts).encode("utf-8"))
 
 
 def _run_as_script():